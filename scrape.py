@@ -10,22 +10,57 @@ from __future__ import (absolute_import, division, print_function,
 
 import csv
 import datetime
+import functools
 import itertools
+import json
+import logging
+import multiprocessing.pool
 import os.path
 import re
+import sys
+from HTMLParser import HTMLParser
 
-import bs4
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import requests_cache
 from unidecode import unidecode
 
 
+_log = logging.getLogger(__name__)
+
 _BASE_URL = 'http://web3.karlsruhe.de/service/abfall/akal/akal.php'
 
 _DATE_RE = re.compile(r'\b(\d\d?)\.(\d\d?).(\d\d\d\d)\b')
 
 _RE_FLAGS = re.UNICODE
 
-_RETRIES_PER_STREET = 3
+_BRACKETED_RE = re.compile(r'\(.*?\)')
+
+_WHITESPACE_RE = re.compile(r'\s')
+
+_DIGIT_RE = re.compile(r'\d')
+
+# Splits a house number into runs of digits and runs of other characters
+_HOUSE_NUMBER_TOKEN_RE = re.compile(r'(\d+)|(\D+)', _RE_FLAGS)
+
+_STR_ABBREVIATION_RE = re.compile(r'str\b', _RE_FLAGS)
+
+_NON_WORD_RE = re.compile(r'[^\w]', _RE_FLAGS)
+
+_RETRIES_PER_REQUEST = 3
+
+# File to which scraped streets are written as they come in
+_DATA_FILENAME = 'data.jsonl'
+
+# Number of streets that are scraped concurrently
+_CONCURRENCY = 16
+
+# Name of the on-disk cache for server responses
+_CACHE_NAME = 'akal_cache'
+
+# Maximum age of cached server responses (in seconds)
+_CACHE_EXPIRE_AFTER = 24 * 60 * 60
 
 
 _SERVICES = {
@@ -36,6 +71,54 @@ _SERVICES = {
     'ka-sperr-365': 'Sperrmüll',
 }
 
+# Service titles as used on the street pages
+_SERVICE_TITLES = {
+    'Restmüll, 14-täglich': 'ka-rest-14',
+    'Bioabfall, wöchentlich': 'ka-bio-7',
+    'Wertstoff, 14-täglich': 'ka-wert-14',
+    'Papier, 4-wöchentlich': 'ka-papier-28',
+    'Sperrmüllabholung': 'ka-sperr-356',
+}
+
+# Matches a table cell that is followed by another cell and captures the
+# text of the first cell and the contents of the second one. The text of
+# the first cell may contain HTML entities and is compared against the
+# service titles after unescaping.
+_SERVICE_ROW_RE = re.compile(
+    r'<td[^>]*>([^<]*)</td>(?=\s*<td[^>]*>(.*?)</td>)',
+    re.DOTALL | _RE_FLAGS)
+
+_TAG_RE = re.compile(r'<[^>]*>')
+
+_unescape = HTMLParser().unescape
+
+# Matches the street selection box and captures its contents
+_STREET_SELECT_RE = re.compile(
+    r'<select[^>]*\bname=["\']strasse["\'][^>]*>(.*?)</select>',
+    re.DOTALL | _RE_FLAGS)
+
+# Captures the text of an option in the street selection box
+_STREET_OPTION_RE = re.compile(r'<option[^>]*>([^<]*)', _RE_FLAGS)
+
+
+def _memoize(func):
+    '''
+    Decorator that caches the return values of a function.
+
+    The function's positional arguments must be hashable. The cache is
+    never cleared.
+    '''
+    cache = {}
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            result = cache[args] = func(*args)
+            return result
+    return wrapper
+
 
 def _remove_bracketed_substrings(s):
     '''
@@ -44,7 +127,7 @@ def _remove_bracketed_substrings(s):
     Removes any substrings in brackets (``()``), including the brackets.
     Nested brackets are not supported.
     '''
-    return re.sub(r'\(.*?\)', '', s)
+    return _BRACKETED_RE.sub('', s)
 
 
 def _extract_dates(s):
@@ -55,62 +138,90 @@ def _extract_dates(s):
     '''
     dates = []
     for candidate in _DATE_RE.finditer(s):
-        groups = map(int, candidate.groups())
+        day, month, year = map(int, candidate.groups())
+        if not (1 <= month <= 12 and 1 <= day <= 31):
+            continue
         try:
-            dates.append(datetime.date(groups[2], groups[1], groups[0]))
+            dates.append(datetime.date(year, month, day))
         except ValueError:
+            # Day does not exist in that month
             pass
     return dates
 
 
-def soup_from_url(url, **kwargs):
+@_memoize
+def _get_session():
+    '''
+    Return the shared session.
+
+    The session keeps connections to the server alive and reuses them;
+    its pool is large enough for all concurrent workers. Failed requests
+    are retried with exponential backoff. Responses are cached on disk
+    so that repeated runs do not hit the server again. The session is
+    created on first use so that importing the module does not create
+    the cache file.
     '''
-    Get an URL and parse it into a ``BeautifulSoup``.
+    session = requests_cache.CachedSession(_CACHE_NAME,
+                                           expire_after=_CACHE_EXPIRE_AFTER)
+    session.mount('http://', HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=_CONCURRENCY,
+        max_retries=Retry(total=_RETRIES_PER_REQUEST, backoff_factor=0.5,
+                          status_forcelist=[500, 502, 503, 504]),
+    ))
+    return session
+
+
+def _fetch(url, **kwargs):
     '''
-    r = requests.get(url, **kwargs)
+    Get an URL and return the response body as text.
+    '''
+    r = _get_session().get(url, **kwargs)
     r.raise_for_status()
-    return bs4.BeautifulSoup(r.text, 'html.parser')
+    return r.text
 
 
 def _get_street_list():
-    soup = soup_from_url(_BASE_URL, params={'von': 'A', 'bis': '['})
-    select = soup.find('select', attrs={'name': 'strasse'})
-    return [opt.text for opt in select.find_all('option')]
+    html = _fetch(_BASE_URL, params={'von': 'A', 'bis': '['})
+    select = _STREET_SELECT_RE.search(html).group(1)
+    return [_unescape(m.group(1)) for m in _STREET_OPTION_RE.finditer(select)]
+
 
+def _parse_dates_from_html(html):
+    '''
+    Extract the collection dates from a street page.
 
-def _scrape_street(street):
+    Returns a dict mapping service IDs to lists of ``YYYY-MM-DD``
+    strings.
+    '''
     dates = {}
-    soup = soup_from_url(_BASE_URL, params={'strasse': street})
-    for key, title in [
-        ('ka-rest-14', 'Restmüll, 14-täglich'),
-        ('ka-bio-7', 'Bioabfall, wöchentlich'),
-        ('ka-wert-14', 'Wertstoff, 14-täglich'),
-        ('ka-papier-28', 'Papier, 4-wöchentlich'),
-        ('ka-sperr-356', 'Sperrmüllabholung'),
-    ]:
-        td = soup.find('td', string=title)
-        if td:
-            text = _remove_bracketed_substrings(td.next_sibling.text)
-            dates[key] = _extract_dates(text)
+    for match in _SERVICE_ROW_RE.finditer(html):
+        key = _SERVICE_TITLES.get(_unescape(match.group(1)))
+        if key is None:
+            continue
+        text = _remove_bracketed_substrings(_TAG_RE.sub('', match.group(2)))
+        dates[key] = [d.isoformat() for d in _extract_dates(text)]
     return dates
 
 
+@_memoize
 def _parse_house_number(number):
     '''
     Parse a house number string.
 
-    Splits the string ``number`` into a list of consecutive letter and
+    Splits the string ``number`` into a tuple of consecutive letter and
     number substrings. The numbers are converted to integers, the
     letters are converted to upper case. The string ``Ende`` (in any
-    case) is treated specially and returns ``['~']`` (which compares
+    case) is treated specially and returns ``('~',)`` (which compares
     as greater with any digit and letter from A-Z).
+
+    Results are cached, which is why a tuple is returned.
     '''
     if number.lower() == 'ende':
-        return ['~']
-    number = re.sub(r'\s', '', number)
-    maps = [lambda x: x.upper(), int]
-    return [maps[x[0]](''.join(x[1])) for x in
-            itertools.groupby(number, key=unicode.isdigit)]
+        return ('~',)
+    number = _WHITESPACE_RE.sub('', number)
+    return tuple(int(digits) if digits else other.upper() for digits, other
+                 in _HOUSE_NUMBER_TOKEN_RE.findall(number))
 
 
 def _unparse_house_number(number):
@@ -121,7 +232,7 @@ def _unparse_house_number(number):
 
 
 def _parse_street(street):
-    first_digit = re.search(r'\d', street)
+    first_digit = _DIGIT_RE.search(street)
     if first_digit is None:
         return street.title(), None
     index = first_digit.start()
@@ -130,32 +241,81 @@ def _parse_street(street):
     return name, numbers
 
 
-def scrape():
+def _fetch_street(street):
+    '''
+    Fetch a street page.
+
+    Returns the page's HTML or ``None`` if the server could not be
+    reached or kept failing after the session's retries. Other HTTP
+    errors are raised.
+    '''
+    try:
+        return _fetch(_BASE_URL, params={'strasse': street})
+    except (requests.ConnectionError, requests.exceptions.RetryError):
+        _log.warning('Could not fetch %s', street)
+        return None
+
+
+def _load_streets(filename):
+    '''
+    Load scraped streets from a JSON lines file.
+
+    Each line contains the record for one street as written by
+    ``scrape``. Returns a dict mapping normalized street names (see
+    ``normalize_street_name``) to sorted lists of ``[numbers, data]``
+    pairs.
+    '''
     streets = {}
-    for street in _get_street_list():
-        name, numbers = _parse_street(street)
-        print(street)
-        data = None
-        for _ in range(_RETRIES_PER_STREET):
-            try:
-                data = {k: [d.strftime('%Y-%m-%d') for d in v] for k, v in
-                            _scrape_street(street).iteritems()}
-            except ValueError:
-                # No date
-                pass
-            except requests.ConnectionError:
-                continue
-            break
-        streets.setdefault(name, []).append([numbers, data])
+    with open(filename) as f:
+        for line in f:
+            record = json.loads(line)
+            numbers = record['numbers']
+            if numbers is not None:
+                numbers = [tuple(number) for number in numbers]
+            key = normalize_street_name(record['name'])
+            streets.setdefault(key, []).append([numbers, record['data']])
     for value in streets.itervalues():
         value.sort()
     return streets
 
 
+def scrape(filename=_DATA_FILENAME):
+    '''
+    Scrape all streets.
+
+    Street pages are fetched concurrently by a pool of threads and
+    parsed as they come in. Each street is written to the JSON lines
+    file ``filename`` as soon as it has been scraped. Once all streets
+    are done the file is loaded via ``_load_streets``.
+    '''
+    street_list = _get_street_list()
+    pool = multiprocessing.pool.ThreadPool(_CONCURRENCY)
+    try:
+        with open(filename, 'w') as f:
+            pages = pool.imap(_fetch_street, street_list)
+            for street, html in itertools.izip(street_list, pages):
+                data = None
+                if html is not None:
+                    data = _parse_dates_from_html(html)
+                name, numbers = _parse_street(street)
+                _log.info(street)
+                record = {'name': name, 'numbers': numbers, 'data': data}
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+    except BaseException:
+        # Don't wait for the remaining streets
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return _load_streets(filename)
+
+
+@_memoize
 def normalize_street_name(name):
     name = unicode(unidecode(name.strip().lower()))
-    name = re.sub(r'str\b', 'strasse', name, flags=_RE_FLAGS)
-    name = re.sub(r'[^\w]', '', name, flags=_RE_FLAGS)
+    name = _STR_ABBREVIATION_RE.sub('strasse', name)
+    name = _NON_WORD_RE.sub('', name)
     return name
 
 
@@ -166,33 +326,36 @@ def csv_export(data):
     csv_opts = {'delimiter': b',', 'quoting': csv.QUOTE_NONNUMERIC}
     with open('services.csv', 'wb') as f:
         writer = csv.writer(f, **csv_opts)
-        for id, title in _SERVICES.iteritems():
-            writer.writerow([id.encode('utf-8'), title.encode('utf-8')])
+        writer.writerows([id.encode('utf-8'), title.encode('utf-8')]
+                         for id, title in _SERVICES.iteritems())
+    rows = []
+    for street, servicedates in data.iteritems():
+        street = street.encode('utf-8')
+        for numbers, services in servicedates:
+            if services is None:
+                # Street could not be scraped
+                continue
+            if numbers is None:
+                numbers = [('0',), ('0',)]
+            if len(numbers) == 1:
+                numbers = [numbers[0], numbers[0]]
+            numbers = [('0',) if x == ('~',) else x for x in numbers]
+            numbers = [_unparse_house_number(x) for x in numbers]
+            for service, dates in services.iteritems():
+                service = service.encode('utf-8')
+                rows.extend(['Karlsruhe', street, numbers[0], numbers[1],
+                             service, date] for date in dates)
     with open('dates.csv', 'wb') as f:
         writer = csv.writer(f, **csv_opts)
-        for street, servicedates in data.iteritems():
-            street = street.encode('utf-8')
-            for numbers, services in servicedates:
-                if numbers is None:
-                    numbers = [['0'], ['0']]
-                if len(numbers) == 1:
-                    numbers = [numbers[0], numbers[0]]
-                numbers = [['0'] if x == ['~'] else x for x in numbers]
-                numbers = [_unparse_house_number(x) for x in numbers]
-                for service, dates in services.iteritems():
-                    service = service.encode('utf-8')
-                    for date in dates:
-                        writer.writerow(['Karlsruhe', street, numbers[0],
-                                         numbers[1], service, date])
+        writer.writerows(rows)
 
 
 if __name__ == '__main__':
     import errno
-    import json
 
+    # Print progress messages to stdout without a log level prefix
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='%(message)s')
     data = scrape()
-    data = {normalize_street_name(key): value
-            for key, value in data.iteritems()}
-
     csv_export(data)
 